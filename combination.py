@@ -1,86 +1,263 @@
 # This module contains implementation of the text string recognition results
 # combination algorithm which accounts for per-character alternatives
 
+import numpy as np
+from numba import njit
+
+# Alignment DP matrix direction labels (int8: one byte per path matrix cell)
+PATH_UNDEFINED = np.int8(-1)
+PATH_MATCHED = np.int8(0)
+PATH_UNMATCHED_BASE = np.int8(1) # 'deletion'
+PATH_UNMATCHED_S = np.int8(2) # 'insertion'
+
+class AlphabetTable:
+    '''
+    Registry mapping character class labels to indices of the membership
+    estimation arrays stored in Cells. Indices are assigned on the first
+    encounter of a label, so all Cells created within a single process
+    share a consistent array layout
+    '''
+    def __init__(self):
+        self.indices = {}   # {<class label>: <array index>}
+        self.chars = []     # reverse mapping: <array index> -> <class label>
+
+    def index(self, char):
+        '''
+        Returns the array index of a class label, registering the label if
+        it was not encountered before
+        '''
+        idx = self.indices.get(char)
+        if idx is None:
+            idx = len(self.chars)
+            self.indices[char] = idx
+            self.chars.append(char)
+        return idx
+
+    def __len__(self):
+        return len(self.chars)
+
+# module-level table shared by all Cells
+ALPHABET = AlphabetTable()
+
+def _padded(probs, size):
+    '''
+    Pads a membership estimation array with zeros up to length 'size'
+    (a class label absent from a Cell has zero membership estimation)
+    '''
+    if len(probs) == size:
+        return probs
+    ret = np.zeros(size, dtype=np.float32)
+    ret[:len(probs)] = probs
+    return ret
+
 class Cell:
     '''
     Object of Cell class represents a single character classification result
     '''
     def __init__(self, varmap):
         '''
-        self.vars: {<class label>: <membership estimation>}
+        self.probs: array of membership estimations indexed by ALPHABET
+        Accepts either {<class label>: <membership estimation>} or a prepared array
         '''
-        self.vars = varmap
+        if isinstance(varmap, np.ndarray):
+            self.probs = np.asarray(varmap, dtype=np.float32)
+        else:
+            # registering all labels first so that the array covers them all
+            indices = [ALPHABET.index(k) for k in varmap.keys()]
+            self.probs = np.zeros(len(ALPHABET), dtype=np.float32)
+            for idx, v in zip(indices, varmap.values()):
+                self.probs[idx] = v
+
+    @property
+    def vars(self):
+        '''
+        Dictionary view {<class label>: <membership estimation>} of the stored array
+        '''
+        return {ALPHABET.chars[i]: float(v) for i, v in enumerate(self.probs)}
+
     def __str__(self):
         return str(self.vars)
     def __repr__(self):
         return str(self.vars)
     def clone(self):
-        return Cell({k: v for k, v in self.vars.items()})    
-    
+        return Cell(self.probs.copy())
+
+    def set_var(self, char, value):
+        '''
+        Sets the membership estimation for a class label, growing the array
+        if the label was registered after this Cell was created
+        '''
+        idx = ALPHABET.index(char)
+        if idx >= len(self.probs):
+            self.probs = _padded(self.probs, len(ALPHABET))
+        self.probs[idx] = value
+
     def normalize(self):
         '''
         Normalizes the current Cell (sum of membership estimations brought to 1)
         '''
-        s = 0.0
-        for k, v in self.vars.items():
-            s += v
-        for k in self.vars.keys():
-            self.vars[k] /= s
-    
+        self.probs /= self.probs.sum()
+
     def normalized(self):
         '''
         Returns a normalized clone of the current Cell
         '''
-        ret = self.clone()
-        ret.normalize()
-        return ret
+        return Cell(self.probs / self.probs.sum())
 
     def best_key(self):
         '''
         Returns class label with highest membership estimation
+        (ties are resolved towards the lexicographically smallest label)
         '''
-        ret = ''
-        best_value = -1.0
-        for k, v in sorted(self.vars.items()):
-            if v > best_value:
-                best_value = v
-                ret = k
-        return ret
+        if len(self.probs) == 0:
+            return ''
+        best_value = self.probs.max()
+        return min(ALPHABET.chars[i] for i in np.flatnonzero(self.probs == best_value))
 
     def best_key_not_from(self, exclusion_mask):
         '''
         Returns class label with highest membership estimation, excluding
         character labels from 'exclusion_mask'
+        (ties are resolved towards the lexicographically smallest label)
         '''
-        ret = ''
-        best_value = -1.0
-        for k, v in sorted(self.vars.items()):
-            if k in exclusion_mask:
-                continue
-            if v > best_value:
-                best_value = v
-                ret = k
-        return ret
-    
+        masked = self.probs.copy()
+        for k in exclusion_mask:
+            idx = ALPHABET.indices.get(k)
+            if idx is not None and idx < len(masked):
+                masked[idx] = -np.inf
+        if len(masked) == 0:
+            return ''
+        best_value = masked.max()
+        if best_value == -np.inf:
+            # every stored label is excluded
+            return ''
+        return min(ALPHABET.chars[i] for i in np.flatnonzero(masked == best_value))
 
-def cell_dist(a, b):
+
+def _stacked(cells, size):
     '''
-    Implements a scaled taxicab metric for Cell objects
+    Stacks the membership estimation arrays of a sequence of Cells into a
+    single 2-D array with rows padded to a common length 'size'
     '''
-    na = a.normalized()
-    nb = b.normalized()
+    ret = np.zeros((len(cells), size), dtype=np.float32)
+    for i, cell in enumerate(cells):
+        ret[i, :len(cell.probs)] = cell.probs
+    return ret
 
-    ret = 0.0
-    for a_key in na.vars.keys():
-        if a_key in nb.vars.keys():
-            ret += abs(na.vars[a_key] - nb.vars[a_key])
-        else:
-            ret += na.vars[a_key]
-    for b_key in nb.vars.keys():
-        if b_key not in na.vars.keys():
-            ret += nb.vars[b_key]
+def _padded_rows(rows, size):
+    '''
+    Pads a stacked 2-D array with zero columns up to row length 'size'
+    (labels registered after the array was built have zero estimations)
+    '''
+    if rows.shape[1] == size:
+        return rows
+    ret = np.zeros((rows.shape[0], size), dtype=np.float32)
+    ret[:, :rows.shape[1]] = rows
+    return ret
 
-    return ret / 2.0    
+def _normalized_rows(rows):
+    '''
+    Normalizes every row of a stacked 2-D array with a single reduction
+    '''
+    return rows / rows.sum(axis=1).reshape(-1, 1)
+
+@njit(cache=True)
+def _levdp(base_probs, s_probs, ec_idx):
+    '''
+    Fills the alignment DP and path matrices for two stacked sequences of
+    normalized membership estimation arrays ('base_probs' and 's_probs',
+    one row per cell). 'ec_idx' is the alphabet index of the empty
+    character label. Returns the (dp, path) matrix pair; the path traceback
+    is done by the caller
+    '''
+    n = base_probs.shape[0]
+    m = s_probs.shape[0]
+    width = base_probs.shape[1]
+
+    # distances of each cell to the empty cell, reused across the whole DP
+    dist_base_ec = np.empty(n, dtype=np.float32)
+    for i in range(n):
+        acc = np.float32(0.0)
+        for k in range(width):
+            if k == ec_idx:
+                acc += abs(base_probs[i, k] - np.float32(1.0))
+            else:
+                acc += abs(base_probs[i, k])
+        dist_base_ec[i] = np.float32(0.5) * acc
+    dist_s_ec = np.empty(m, dtype=np.float32)
+    for j in range(m):
+        acc = np.float32(0.0)
+        for k in range(width):
+            if k == ec_idx:
+                acc += abs(s_probs[j, k] - np.float32(1.0))
+            else:
+                acc += abs(s_probs[j, k])
+        dist_s_ec[j] = np.float32(0.5) * acc
+
+    # dp[i][j] = levenshtein(base[preflen i], s[preflen j])
+    # the boundary rows are prefix sums of the empty-cell distances
+    dp = np.zeros((n + 1, m + 1), dtype=np.float32)
+    path = np.full((n + 1, m + 1), PATH_UNDEFINED, dtype=np.int8)
+    dp[0, 1:] = np.cumsum(dist_s_ec)
+    path[0, 1:] = PATH_UNMATCHED_S
+    dp[1:, 0] = np.cumsum(dist_base_ec)
+    path[1:, 0] = PATH_UNMATCHED_BASE
+
+    # the DP recurrence only depends on the previous two anti-diagonals, so the
+    # cells of one anti-diagonal (b_preflen + s_preflen = diag) are independent
+    # of each other; iterating over anti-diagonals exposes this wavefront
+    # parallelism to the compiler's vectorizer
+    for diag in range(2, n + m + 1):
+        for b_preflen in range(max(1, diag - m), min(n, diag - 1) + 1):
+            s_preflen = diag - b_preflen
+            # cell from base is aligned with empty cell
+            pen_unmatched_base = dist_base_ec[b_preflen - 1] + dp[b_preflen - 1, s_preflen]
+            # cell from input is aligned with empty cell
+            pen_unmatched_s    = dist_s_ec[s_preflen - 1] + dp[b_preflen, s_preflen - 1]
+            # cells from base and input are aligned together
+            acc = np.float32(0.0)
+            for k in range(width):
+                acc += abs(base_probs[b_preflen - 1, k] - s_probs[s_preflen - 1, k])
+            pen_matched        = np.float32(0.5) * acc + dp[b_preflen - 1, s_preflen - 1]
+
+            # single branch tree determining both the DP value and the path
+            # label (same tie-breaking as separate min() calls would give:
+            # a matched pair wins only when strictly best)
+            if pen_matched < pen_unmatched_base and pen_matched < pen_unmatched_s:
+                dp[b_preflen, s_preflen] = pen_matched
+                path[b_preflen, s_preflen] = PATH_MATCHED
+            elif pen_unmatched_base < pen_unmatched_s:
+                dp[b_preflen, s_preflen] = pen_unmatched_base
+                path[b_preflen, s_preflen] = PATH_UNMATCHED_BASE
+            else:
+                dp[b_preflen, s_preflen] = pen_unmatched_s
+                path[b_preflen, s_preflen] = PATH_UNMATCHED_S
+
+    return dp, path
+
+def _row_best_key_not_from(row, es_idx):
+    '''
+    Returns the class label with highest membership estimation in a stacked
+    base row, excluding the label with alphabet index 'es_idx'
+    (ties are resolved towards the lexicographically smallest label)
+    '''
+    masked = row.copy()
+    masked[es_idx] = -np.inf
+    best_value = masked.max()
+    if best_value == -np.inf:
+        return ''
+    return min(ALPHABET.chars[i] for i in np.flatnonzero(masked == best_value))
+
+def cell_dist(a, b):
+    '''
+    Implements a scaled taxicab metric for Cell objects
+    '''
+    pa, pb = a.probs, b.probs
+    if len(pa) != len(pb):
+        size = max(len(pa), len(pb))
+        pa = _padded(pa, size)
+        pb = _padded(pb, size)
+    return float(0.5 * np.abs(pa / pa.sum() - pb / pb.sum()).sum())
 
 
 def merge_cells(a, b, wa, wb):
@@ -89,21 +266,23 @@ def merge_cells(a, b, wa, wb):
     Output membership estimations for each class are weighted average of corresponding
     ones from a and b
     '''
-    na = a.normalized()
-    nb = b.normalized()
-    
-    ret = na.clone()
-    for b_key in nb.vars.keys():
-        if b_key in ret.vars.keys(): # keys in both cells
-            ret.vars[b_key] = (wa * ret.vars[b_key] + wb * nb.vars[b_key]) / (wa + wb)
-        else: # only b-keys
-            ret.vars[b_key] = (wb * nb.vars[b_key]) / (wa + wb)
-    for a_key in na.vars.keys():
-        if a_key not in nb.vars.keys(): # only a-keys
-            ret.vars[a_key] = (wa * ret.vars[a_key]) / (wa + wb)
-    
-    return ret
-    
+    pa, pb = a.probs, b.probs
+    if len(pa) != len(pb):
+        size = max(len(pa), len(pb))
+        pa = _padded(pa, size)
+        pb = _padded(pb, size)
+    na = pa / pa.sum()
+    nb = pb / pb.sum()
+    return Cell((wa * na + wb * nb) / (wa + wb))
+
+def merge_cells_normalized(ra, rb, wa, wb):
+    '''
+    Combines two already normalized rows of membership estimations with
+    respective weights wa and wb (fast path of merge_cells which skips
+    renormalizing the inputs)
+    '''
+    return (wa * ra + wb * rb) / (wa + wb)
+
 def levmetric_ocr(ocr_string1, ocr_string2):
     '''
     Computes a normalized Generalized Levenshtein Distance for two text string
@@ -112,31 +291,54 @@ def levmetric_ocr(ocr_string1, ocr_string2):
     if (len(ocr_string1) == 0) and (len(ocr_string2) == 0):
         return 0.0;
 
-    # levenshtein DP matrix: <len base> x <len s>
-    dp = [[] for i in range(len(ocr_string1) + 1)]
-    for i in range(len(ocr_string1) + 1):
-        dp[i] = [0.0 for j in range(len(ocr_string2) + 1)]
-
-    # dp[i][j] is a prefix-wise distance levenshtein(a[preflen i], b[preflen j])
-    dp[0][0] = 0.0
-    for s_preflen in range(1, len(ocr_string2) + 1):
-        dp[0][s_preflen] = cell_dist(ocr_string2[s_preflen - 1], Cell({'@': 1.0})) + dp[0][s_preflen - 1]
-    for b_preflen in range(1, len(ocr_string1) + 1):
-        dp[b_preflen][0] = cell_dist(ocr_string1[b_preflen - 1], Cell({'@': 1.0})) + dp[b_preflen - 1][0]
-    
-    for b_preflen in range(1, len(ocr_string1) + 1):
-        for s_preflen in range(1, len(ocr_string2) + 1):
+    # registering the empty character label before sizing the rows, so that
+    # its index is covered even if no Cell has carried it yet
+    ec_idx = ALPHABET.index('@')
+
+    # inputs can be sequences of Cells or stacked 2-D arrays (one row per cell);
+    # both are brought to a common row length and batch-normalized
+    size = len(ALPHABET)
+    a = ocr_string1 if isinstance(ocr_string1, np.ndarray) else _stacked(ocr_string1, size)
+    b = ocr_string2 if isinstance(ocr_string2, np.ndarray) else _stacked(ocr_string2, size)
+    size = max(a.shape[1], b.shape[1], ec_idx + 1)
+    a = _normalized_rows(_padded_rows(a, size))
+    b = _normalized_rows(_padded_rows(b, size))
+
+    # distances of each cell to the empty cell, computed once: the inner DP
+    # loop below reuses the same value <len ocr_string> times
+    ec_row = np.zeros(size, dtype=np.float32)
+    ec_row[ec_idx] = 1.0
+    dist1_ec = 0.5 * np.abs(a - ec_row).sum(axis=1)
+    dist2_ec = 0.5 * np.abs(b - ec_row).sum(axis=1)
+
+    # only the final distance value is needed (no traceback), so two rolling
+    # DP rows suffice; the shorter string is used as the inner dimension
+    if a.shape[0] < b.shape[0]:
+        a, b = b, a
+        dist1_ec, dist2_ec = dist2_ec, dist1_ec
+
+    # prev[j] = levenshtein(a[preflen i-1], b[preflen j])
+    prev = np.empty(b.shape[0] + 1, dtype=np.float32)
+    curr = np.empty_like(prev)
+    # the boundary row is a prefix sum of the empty-cell distances
+    prev[0] = 0.0
+    prev[1:] = np.cumsum(dist2_ec)
+
+    for b_preflen in range(1, a.shape[0] + 1):
+        curr[0] = dist1_ec[b_preflen - 1] + prev[0]
+        for s_preflen in range(1, b.shape[0] + 1):
             # cell from ocr_string1 is aligned with empty cell
-            pen_unmatched_base = cell_dist(ocr_string1[b_preflen - 1], Cell({'@': 1.0})) + dp[b_preflen - 1][s_preflen]
+            pen_unmatched_base = dist1_ec[b_preflen - 1] + prev[s_preflen]
             # cell from ocr_string2 is aligned with empty cell
-            pen_unmatched_s    = cell_dist(ocr_string2[s_preflen - 1], Cell({'@': 1.0})) + dp[b_preflen][s_preflen - 1]
+            pen_unmatched_s    = dist2_ec[s_preflen - 1] + curr[s_preflen - 1]
             # cells of ocr_string1 and ocr_string2 are aligned together
-            pen_matched        = cell_dist(ocr_string1[b_preflen - 1], ocr_string2[s_preflen - 1]) + dp[b_preflen - 1][s_preflen - 1]
-            
-            dp[b_preflen][s_preflen] = min(pen_unmatched_base, pen_unmatched_s, pen_matched)
+            pen_matched        = 0.5 * np.abs(a[b_preflen - 1] - b[s_preflen - 1]).sum() + prev[s_preflen - 1]
+
+            curr[s_preflen] = min(pen_unmatched_base, pen_unmatched_s, pen_matched)
+        prev, curr = curr, prev
 
     # Generalized Levenshtein Distance value
-    levenshtein = dp[len(ocr_string1)][len(ocr_string2)]
+    levenshtein = float(prev[b.shape[0]])
     # returning normalized value
     return 2.0 * levenshtein / (len(ocr_string1) + len(ocr_string2) + levenshtein)
 
@@ -156,16 +358,16 @@ class Alignment:
         self.es   = '@'                     # empty character label
         self.ec   = Cell({self.es: 1.0})    # empty cell template
         self.ew   = empty_weight            # weight of empty character (for string result generation)
-        
+
     def clone(self):
         '''
         Clones the full structure
         '''
         ret = Alignment(self.ew)
-        ret.base = [elem.clone() for elem in self.base]
+        ret.base = self.base.copy()
         ret.base_weight = self.base_weight
         return ret
-            
+
     def add_string(self, arg_s, weight):
         '''
         Adds a new text string recognition result with weight 'weight'
@@ -175,73 +377,52 @@ class Alignment:
         if len(s) == 0:
             # empty sequence is normalized as a sequence of a single empty Cell
             s = [self.ec.clone()]
+
+        # the base is stored as a stacked 2-D array with one normalized row of
+        # membership estimations per cell; the input is brought to the same
+        # layout with a single batch normalization
+        size = len(ALPHABET)
+        S = _normalized_rows(_stacked(s, size))
         if self.base is None:
             # the first input becomes the new base
-            self.base = [c.normalized() for c in s]
+            self.base = S
             self.base_weight = weight
             return
-           
-        # Alignment DP matrix direction labels
-        PATH_UNDEFINED = -1
-        PATH_MATCHED = 0
-        PATH_UNMATCHED_BASE = 1 # 'deletion'
-        PATH_UNMATCHED_S = 2 # 'insertion'
-                    
-        # levenshtein DP matrix: <len base> x <len s>
-        dp = [[] for i in range(len(self.base) + 1)]
-        path = [[] for i in range(len(self.base) + 1)]
-        for i in range(len(self.base) + 1):
-            dp[i] = [0.0 for j in range(len(s) + 1)]
-            path[i] = [PATH_UNDEFINED for j in range(len(s) + 1)]
-            
-        # dp[i][j] = levenshtein(base[preflen i], s[preflen j])
-        dp[0][0] = 0.0
-        path[0][0] = PATH_UNDEFINED
-        for s_preflen in range(1, len(s) + 1):
-            dp[0][s_preflen] = cell_dist(s[s_preflen - 1], self.ec) + dp[0][s_preflen - 1]
-            path[0][s_preflen] = PATH_UNMATCHED_S
-        for b_preflen in range(1, len(self.base) + 1):
-            dp[b_preflen][0] = cell_dist(self.base[b_preflen - 1], self.ec) + dp[b_preflen - 1][0]
-            path[b_preflen][0] = PATH_UNMATCHED_BASE
-        
-        for b_preflen in range(1, len(self.base) + 1):
-            for s_preflen in range(1, len(s) + 1):
-                # cell from base is aligned with empty cell
-                pen_unmatched_base = cell_dist(self.base[b_preflen - 1], self.ec) + dp[b_preflen - 1][s_preflen]
-                # cell from input is aligned with empty cell
-                pen_unmatched_s    = cell_dist(s[s_preflen - 1], self.ec) + dp[b_preflen][s_preflen - 1]
-                # cells from base and input are aligned together
-                pen_matched        = cell_dist(self.base[b_preflen - 1], s[s_preflen - 1]) + dp[b_preflen - 1][s_preflen - 1]
-                
-                dp[b_preflen][s_preflen] = min(pen_unmatched_base, pen_unmatched_s, pen_matched)
-                # determining the path label to trace the path after DP
-                if pen_matched < min(pen_unmatched_base, pen_unmatched_s):
-                    path[b_preflen][s_preflen] = PATH_MATCHED
-                elif pen_unmatched_base < pen_unmatched_s:
-                    path[b_preflen][s_preflen] = PATH_UNMATCHED_BASE
-                else:
-                    path[b_preflen][s_preflen] = PATH_UNMATCHED_S
-        
+        self.base = _padded_rows(self.base, size)
+
+        # filling the DP and path matrices with the compiled kernel
+        dp, path = _levdp(self.base, S, ALPHABET.index(self.es))
+
         # tracing path: building new base
+        ec_row = np.zeros(size, dtype=np.float32)
+        ec_row[ALPHABET.index(self.es)] = 1.0
+        wa = self.base_weight
+        wb = weight
         new_base = []
-        
-        cur_b_preflen = len(self.base)
-        cur_s_preflen = len(s)
+
+        cur_b_preflen = self.base.shape[0]
+        cur_s_preflen = S.shape[0]
         while cur_b_preflen > 0 or cur_s_preflen > 0:
-            if path[cur_b_preflen][cur_s_preflen] == PATH_MATCHED:
-                new_base.append(merge_cells(self.base[cur_b_preflen - 1], s[cur_s_preflen - 1], self.base_weight, weight))
+            if path[cur_b_preflen, cur_s_preflen] == PATH_MATCHED:
+                ra = self.base[cur_b_preflen - 1]
+                rb = S[cur_s_preflen - 1]
                 cur_b_preflen -= 1
-                cur_s_preflen -= 1                
-            elif path[cur_b_preflen][cur_s_preflen] == PATH_UNMATCHED_BASE:
-                new_base.append(merge_cells(self.base[cur_b_preflen - 1], self.ec, self.base_weight, weight))
+                cur_s_preflen -= 1
+            elif path[cur_b_preflen, cur_s_preflen] == PATH_UNMATCHED_BASE:
+                ra = self.base[cur_b_preflen - 1]
+                rb = ec_row
                 cur_b_preflen -= 1
-            elif path[cur_b_preflen][cur_s_preflen] == PATH_UNMATCHED_S:
-                new_base.append(merge_cells(self.ec, s[cur_s_preflen - 1], self.base_weight, weight))
+            else:
+                ra = ec_row
+                rb = S[cur_s_preflen - 1]
                 cur_s_preflen -= 1
+            # both rows are normalized by construction, so the renormalizing
+            # half of merge_cells is skipped
+            new_base.append(merge_cells_normalized(ra, rb, wa, wb))
         new_base.reverse()
-        
+
         # setting a new base
-        self.base = new_base
+        self.base = np.stack(new_base)
         self.base_weight += weight
 
     def get_string_result(self):
@@ -249,10 +430,11 @@ class Alignment:
         Returns the string representation of a base, to compare with ground truth
         '''
         ret = ''
-        for cell in self.base:
-            best_nonempty = cell.best_key_not_from(self.es)
-            best_nonempty_score = 0.0 if best_nonempty == '' else cell.vars[best_nonempty]
-            empty_score         = 0.0 if self.es not in cell.vars.keys() else cell.vars[self.es]
+        es_idx = ALPHABET.index(self.es)
+        for row in self.base:
+            best_nonempty = _row_best_key_not_from(row, es_idx)
+            best_nonempty_score = 0.0 if best_nonempty == '' else float(row[ALPHABET.indices[best_nonempty]])
+            empty_score         = float(row[es_idx])
             if best_nonempty_score > empty_score * self.ew:
                 ret += best_nonempty
-        return ret      
\ No newline at end of file
+        return ret
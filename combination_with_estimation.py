@@ -1,5 +1,9 @@
-from combination import Cell, cell_dist, merge_cells, levmetric_ocr
-from treap import Treap
+import numpy as np
+
+from combination import Cell, cell_dist, merge_cells, merge_cells_normalized, levmetric_ocr, \
+    ALPHABET, _stacked, _padded_rows, _normalized_rows, _levdp, _row_best_key_not_from, \
+    PATH_UNDEFINED, PATH_MATCHED, PATH_UNMATCHED_BASE, PATH_UNMATCHED_S
+from treap import Treap, _treap_get_lower
 
 class TreapBasedSequenceStructure:
     '''
@@ -12,7 +16,7 @@ class TreapBasedSequenceStructure:
         '''
         Returns a sum of inserted elements (subtree_sum of the root node of a tree)
         '''
-        return 0.0 if self.treap.root == -1 else self.treap.nodes[self.treap.root].subtree_sum
+        return 0.0 if self.treap.root == -1 else float(self.treap.subtree_sum[self.treap.root])
 
     def insert(self, element):
         '''
@@ -24,16 +28,28 @@ class TreapBasedSequenceStructure:
         '''
         Returns approximation of the sum of distances required for next combined result modelling
         '''
-        ret = 0.0
+        # gathering the per-(cell, class) sums and lower-than-average statistics
+        # first and reducing them with a single vectorized expression; the
+        # compiled tree walk is called directly on the node arrays of each
+        # treap (per-treap storage keeps the walks separate)
+        sums = []
+        cnt_lower = []
+        sum_lower = []
         for cell in Y:
             for c in cell.keys():
-                s = cell[c].get_sum()
-                lc, ls = cell[c].treap.get_lower(cell[c].treap.root, s / n)
-                ret += s * lc - n * ls
+                treap = cell[c].treap
+                s = 0.0 if treap.root == -1 else float(treap.subtree_sum[treap.root])
+                lc, ls = _treap_get_lower(treap.element, treap.subtree_sum, treap.subtree_cnt, \
+                                          treap.left_node, treap.right_node, treap.root, s / n)
+                sums.append(s)
+                cnt_lower.append(lc)
+                sum_lower.append(ls)
+        sums = np.asarray(sums)
+        ret = float((sums * np.asarray(cnt_lower) - n * np.asarray(sum_lower)).sum())
         # quickly computed approximation of GLD
         ret /= (n * (n + 1))
         # post-summation normalization: a rough approximation of normalized GLD
-        return 2 * ret / (ret + 2 * len(Y)) 
+        return 2 * ret / (ret + 2 * len(Y))
 
 class ListBasedSequenceStructure:
     def __init__(self):
@@ -57,17 +73,18 @@ class ListBasedSequenceStructure:
         '''
         Returns approximation of the sum of distances required for next combined result modelling
         '''
-        d = [0.0 for _ in range(n)] # separate GLD for each combined sample
+        d = np.zeros(n) # separate GLD for each combined sample
         for cell in Y:
             for c in cell.keys():
                 s = cell[c].get_sum()
-                for i, e in enumerate(cell[c].elements):
-                    d[i] += abs(s - n * e)
-        for i in range(n):
-            d[i] /= (2 * n * (n + 1))
-            # normalizing each GLD separately
-            d[i] = 2.0 * d[i] / (d[i] + 2 * len(Y))
-        return sum(d)
+                # sequences of cells inserted at later samples are shorter
+                # than n; their elements keep mapping to the first samples
+                e = np.asarray(cell[c].elements)
+                d[:len(e)] += np.abs(s - n * e)
+        d /= (2 * n * (n + 1))
+        # normalizing each GLD separately
+        d = 2.0 * d / (d + 2 * len(Y))
+        return float(d.sum())
 
 
 class AlignmentWithEstimation:
@@ -107,20 +124,27 @@ class AlignmentWithEstimation:
             if self.alphabet is not None:
                 for c in self.alphabet:
                     if c != self.es:
-                        s[0].vars[c] = 0.0
+                        s[0].set_var(c, 0.0)
             empty_input_string = True
 
+        # the base is stored as a stacked 2-D array with one normalized row of
+        # membership estimations per cell; the input is brought to the same
+        # layout with a single batch normalization (the Cells of 's' keep the
+        # raw estimations for the stored sequences Y)
+        size = len(ALPHABET)
+        S = _normalized_rows(_stacked(s, size))
         if self.base is None:
             # the first input becomes the new base
-            self.base = [c.normalized() for c in s]
+            self.base = S
             self.base_samples = 1
-            
+
             self.Y = []
-            for cell in self.base:
+            for row in self.base:
                 y = {}
-                for c, v in cell.vars.items():
+                for i in range(len(row)):
+                    c = ALPHABET.chars[i]
                     y[c] = self.SequenceStructure()
-                    y[c].insert(v)
+                    y[c].insert(float(row[i]))
                 self.Y.append(y)
             if not empty_input_string:
                 # initializing alphabet
@@ -138,64 +162,32 @@ class AlignmentWithEstimation:
                         for _ in range(self.base_samples):
                             self.Y[i][c].insert(0.0)
            
-        # Alignment DP matrix direction labels
-        PATH_UNDEFINED = -1
-        PATH_MATCHED = 0
-        PATH_UNMATCHED_BASE = 1 # 'deletion'
-        PATH_UNMATCHED_S = 2 # 'insertion'
-                    
-        # levenshtein DP matrix: <len base> x <len s>
-        dp = [[] for i in range(len(self.base) + 1)]
-        path = [[] for i in range(len(self.base) + 1)]
-        for i in range(len(self.base) + 1):
-            dp[i] = [0.0 for j in range(len(s) + 1)]
-            path[i] = [PATH_UNDEFINED for j in range(len(s) + 1)]
-            
-        # dp[i][j] = levenshtein(base[preflen i], s[preflen j])
-        dp[0][0] = 0.0
-        path[0][0] = PATH_UNDEFINED
-        for s_preflen in range(1, len(s) + 1):
-            dp[0][s_preflen] = cell_dist(s[s_preflen - 1], self.ec) + dp[0][s_preflen - 1]
-            path[0][s_preflen] = PATH_UNMATCHED_S
-        for b_preflen in range(1, len(self.base) + 1):
-            dp[b_preflen][0] = cell_dist(self.base[b_preflen - 1], self.ec) + dp[b_preflen - 1][0]
-            path[b_preflen][0] = PATH_UNMATCHED_BASE
-        
-        for b_preflen in range(1, len(self.base) + 1):
-            for s_preflen in range(1, len(s) + 1):
-                # cell from base is aligned with empty cell
-                pen_unmatched_base = cell_dist(self.base[b_preflen - 1], self.ec) + dp[b_preflen - 1][s_preflen]
-                # cell from input is aligned with empty cell
-                pen_unmatched_s    = cell_dist(s[s_preflen - 1], self.ec) + dp[b_preflen][s_preflen - 1]
-                # cells from base and input are aligned together
-                pen_matched        = cell_dist(self.base[b_preflen - 1], s[s_preflen - 1]) + dp[b_preflen - 1][s_preflen - 1]
-                
-                dp[b_preflen][s_preflen] = min(pen_unmatched_base, pen_unmatched_s, pen_matched)
-                # determining the path label to trace the path after DP
-                if pen_matched < min(pen_unmatched_base, pen_unmatched_s):
-                    path[b_preflen][s_preflen] = PATH_MATCHED
-                elif pen_unmatched_base < pen_unmatched_s:
-                    path[b_preflen][s_preflen] = PATH_UNMATCHED_BASE
-                else:
-                    path[b_preflen][s_preflen] = PATH_UNMATCHED_S
-        
+        # filling the DP and path matrices with the compiled kernel
+        self.base = _padded_rows(self.base, size)
+        dp, path = _levdp(self.base, S, ALPHABET.index(self.es))
+
         # tracing path: building new base
+        ec_row = np.zeros(size, dtype=np.float32)
+        ec_row[ALPHABET.index(self.es)] = 1.0
+        wa = self.base_samples
         new_base = []
         new_Y = []
-        
-        cur_b_preflen = len(self.base)
-        cur_s_preflen = len(s)
+
+        cur_b_preflen = self.base.shape[0]
+        cur_s_preflen = S.shape[0]
         while cur_b_preflen > 0 or cur_s_preflen > 0:
-            if path[cur_b_preflen][cur_s_preflen] == PATH_MATCHED:
-                new_base.append(merge_cells(self.base[cur_b_preflen - 1], s[cur_s_preflen - 1], self.base_samples, 1))
+            if path[cur_b_preflen, cur_s_preflen] == PATH_MATCHED:
+                ra = self.base[cur_b_preflen - 1]
+                rb = S[cur_s_preflen - 1]
                 # updating Y
                 new_Y.append(self.Y[cur_b_preflen - 1])
                 for c, v in s[cur_s_preflen - 1].vars.items():
                     new_Y[-1][c].insert(v)
                 cur_b_preflen -= 1
-                cur_s_preflen -= 1                
-            elif path[cur_b_preflen][cur_s_preflen] == PATH_UNMATCHED_BASE:
-                new_base.append(merge_cells(self.base[cur_b_preflen - 1], self.ec, self.base_samples, 1))
+                cur_s_preflen -= 1
+            elif path[cur_b_preflen, cur_s_preflen] == PATH_UNMATCHED_BASE:
+                ra = self.base[cur_b_preflen - 1]
+                rb = ec_row
                 # updating Y
                 new_Y.append(self.Y[cur_b_preflen - 1])
                 if self.alphabet is None:
@@ -206,8 +198,9 @@ class AlignmentWithEstimation:
                             new_Y[-1][c].insert(0.0)
                     new_Y[-1][self.es].insert(1.0)
                 cur_b_preflen -= 1
-            elif path[cur_b_preflen][cur_s_preflen] == PATH_UNMATCHED_S:
-                new_base.append(merge_cells(self.ec, s[cur_s_preflen - 1], self.base_samples, 1))
+            else:
+                ra = ec_row
+                rb = S[cur_s_preflen - 1]
                 # updatind Y
                 y = {}
                 for c, v in s[cur_s_preflen - 1].vars.items():
@@ -224,26 +217,30 @@ class AlignmentWithEstimation:
                     y[c].insert(v)
                 new_Y.append(y)
                 cur_s_preflen -= 1
+            # both rows are normalized by construction, so the renormalizing
+            # half of merge_cells is skipped
+            new_base.append(merge_cells_normalized(ra, rb, wa, 1))
         new_base.reverse()
         new_Y.reverse()
 
         # setting a new base
-        self.base = new_base
+        self.base = np.stack(new_base)
         self.base_samples += 1
         self.Y = new_Y
 
     def get_string_result(self):
         '''
         Returns the string representation of a base, to compare with ground truth
-        '''        
+        '''
         ret = ''
-        for cell in self.base:
-            best_nonempty = cell.best_key_not_from(self.es)
-            best_nonempty_score = 0.0 if best_nonempty == '' else cell.vars[best_nonempty]
-            empty_score         = 0.0 if self.es not in cell.vars.keys() else cell.vars[self.es]
+        es_idx = ALPHABET.index(self.es)
+        for row in self.base:
+            best_nonempty = _row_best_key_not_from(row, es_idx)
+            best_nonempty_score = 0.0 if best_nonempty == '' else float(row[ALPHABET.indices[best_nonempty]])
+            empty_score         = float(row[es_idx])
             if best_nonempty_score > empty_score * self.ew:
                 ret += best_nonempty
-        return ret      
+        return ret
 
     def get_modelling_sum(self):
         '''
@@ -1,39 +1,27 @@
-# This python module contains implementations for basic functions 
+# This python module contains implementations for basic functions
 # required for the experiments
 
+from functools import lru_cache
+
+from rapidfuzz.distance import Levenshtein as _Levenshtein
+
+@lru_cache(maxsize=65536)
 def normalize_string(string):
     '''
-    Normalizes a recognition result string by converting it to upper case and 
+    Normalizes a recognition result string by converting it to upper case and
     replacing the letter O to the digit 0 for ease of recognition results comparison
+    (results are memoized: the same ideal value is normalized over and over in
+    the modelling loops)
     '''
     return string.upper().replace('O', '0')
 
 def levenshtein(a, b):
     '''
     Computes a common Levenshtein distance between two strings X and Y
-    Complexity O(|X|*|Y|)
-    '''
-    if min(len(a), len(b)) == 0:
-        return max(len(a), len(b))
-    
-    dp = [[] for i in range(len(a) + 1)]
-    for i in range(len(a) + 1):
-        dp[i] = [0 for j in range(len(b) + 1)]
-        
-    # dp[i][j] is a prefix-wise distance levenshtein(a[preflen i], b[preflen j])
-    for b_preflen in range(len(b) + 1):
-        dp[0][b_preflen] = b_preflen
-    for a_preflen in range(1, len(a) + 1):
-        dp[a_preflen][0] = a_preflen
-        for b_preflen in range(1, len(b) + 1):
-            # insertion or deletion (penalty 1)
-            dp[a_preflen][b_preflen] = 1 + min(dp[a_preflen - 1][b_preflen], dp[a_preflen][b_preflen - 1])
-            # substitution penalty
-            subs_penalty = 0 if (a[a_preflen - 1] == b[b_preflen - 1]) else 1
-            # substitution
-            dp[a_preflen][b_preflen] = min(dp[a_preflen][b_preflen], subs_penalty + dp[a_preflen - 1][b_preflen - 1])
-    
-    return dp[len(a)][len(b)]
+    Delegates to the bit-parallel (Myers/Hyyrö) implementation from rapidfuzz,
+    complexity O(|X|*|Y|/64)
+    '''
+    return _Levenshtein.distance(a, b)
 
 def end_to_end(result, ideal):
     '''
@@ -1,129 +1,235 @@
 # This module implements a simple balanced binary search tree (Cartesian tree aka Treap)
 # It supports insertion and query for the number and sum of elements which have value
 # lower than the average value of inserted items.
+#
+# Node storage is flattened into parallel arrays ('structure of arrays'): per-node
+# fields live in NumPy arrays indexed by node number, and the tree operations are
+# compiled free functions walking those arrays (-1 marks a missing child/root).
 
-import random
+import numpy as np
+from numba import njit
 
-class TreapNode:
+@njit(cache=True)
+def _treap_update_subtree(element, subtree_sum, subtree_cnt, left_node, right_node, node):
     '''
-    Class representing a node of a tree
+    Updates subtree_sum and subtree_cnt of a node with index 'node' assuming that
+    all children have valid values, O(1)
     '''
-    def __init__(self):
-        self.element = 0.0      # value of stored element
-        self.subtree_sum = 0.0  # sum of values in a subtree (including this node)
-        self.subtree_cnt = 0    # number of nodes in a subtree (including this node)
-        self.weight = 0.0       # balancing weight
-        self.left_node = -1     # index of left child (-1 if there are none)
-        self.right_node = -1    # index of right child (-1 if there are none)
+    subtree_sum[node] = element[node]
+    subtree_cnt[node] = 1
+    l = left_node[node]
+    if l != -1:
+        subtree_sum[node] += subtree_sum[l]
+        subtree_cnt[node] += subtree_cnt[l]
+    r = right_node[node]
+    if r != -1:
+        subtree_sum[node] += subtree_sum[r]
+        subtree_cnt[node] += subtree_cnt[r]
+
+@njit(cache=True)
+def _treap_split(element, subtree_sum, subtree_cnt, left_node, right_node, node, key):
+    '''
+    Splits the subtree with root at 'node' into two unconnected trees, the first containing
+    all elements lower than 'key'. Returns two roots, O(log n)
+    The descent path is remembered and the subtree values are updated bottom-up
+    after the relinking
+    '''
+    left_root = -1
+    right_root = -1
+    left_attach = -1    # deepest node of the left part (next left node attaches to its right)
+    right_attach = -1   # deepest node of the right part (next right node attaches to its left)
+    touched = []        # descent path, for bottom-up subtree updates
+    while node != -1:
+        touched.append(node)
+        if key < element[node]:
+            # 'node' goes to the right part, descending left
+            if right_attach == -1:
+                right_root = node
+            else:
+                left_node[right_attach] = node
+            right_attach = node
+            node = left_node[node]
+        else:
+            # 'node' goes to the left part, descending right
+            if left_attach == -1:
+                left_root = node
+            else:
+                right_node[left_attach] = node
+            left_attach = node
+            node = right_node[node]
+    if left_attach != -1:
+        right_node[left_attach] = -1
+    if right_attach != -1:
+        left_node[right_attach] = -1
+    for i in range(len(touched) - 1, -1, -1):
+        _treap_update_subtree(element, subtree_sum, subtree_cnt, left_node, right_node, touched[i])
+    return left_root, right_root
+
+@njit(cache=True)
+def _treap_join(element, subtree_sum, subtree_cnt, left_node, right_node, weight, left, right):
+    '''
+    Joins two trees with root indices at 'left' and 'right' and returns a single root, O(log n)
+    The heavier root is attached to the merged tree at each step, and the subtree
+    values are updated bottom-up at the end
+    '''
+    root = -1
+    attach = -1         # node of the merged tree the next pick attaches to
+    attach_right = True # which child link of 'attach' receives the next pick
+    touched = []        # descent path, for bottom-up subtree updates
+    while left != -1 and right != -1:
+        if weight[left] > weight[right]:
+            pick = left
+            left = right_node[left]
+            pick_right = True
+        else:
+            pick = right
+            right = left_node[right]
+            pick_right = False
+        if attach == -1:
+            root = pick
+        elif attach_right:
+            right_node[attach] = pick
+        else:
+            left_node[attach] = pick
+        touched.append(pick)
+        attach = pick
+        attach_right = pick_right
+    remainder = left if left != -1 else right
+    if attach == -1:
+        root = remainder
+    elif attach_right:
+        right_node[attach] = remainder
+    else:
+        left_node[attach] = remainder
+    for i in range(len(touched) - 1, -1, -1):
+        _treap_update_subtree(element, subtree_sum, subtree_cnt, left_node, right_node, touched[i])
+    return root
+
+@njit(cache=True)
+def _treap_add_element_internal(element, subtree_sum, subtree_cnt, left_node, right_node, weight, node, new_node):
+    '''
+    Adds the node with index 'new_node' (fields already filled in) inside a subtree
+    with root 'node' and returns the new root of that subtree, O(log n)
+    Descends while the stored weights dominate, then splits the displaced subtree
+    by the new element
+    '''
+    root = node
+    parent = -1
+    parent_left = False # which child link of 'parent' the new node replaces
+    touched = []        # descent path, for bottom-up subtree updates
+    while node != -1 and weight[new_node] <= weight[node]:
+        touched.append(node)
+        parent = node
+        if element[new_node] < element[node]:
+            parent_left = True
+            node = left_node[node]
+        else:
+            parent_left = False
+            node = right_node[node]
+    # the new node takes the place of the displaced subtree, adopting its split parts
+    l, r = _treap_split(element, subtree_sum, subtree_cnt, left_node, right_node, node, element[new_node])
+    left_node[new_node] = l
+    right_node[new_node] = r
+    _treap_update_subtree(element, subtree_sum, subtree_cnt, left_node, right_node, new_node)
+    if parent == -1:
+        root = new_node
+    elif parent_left:
+        left_node[parent] = new_node
+    else:
+        right_node[parent] = new_node
+    for i in range(len(touched) - 1, -1, -1):
+        _treap_update_subtree(element, subtree_sum, subtree_cnt, left_node, right_node, touched[i])
+    return root
+
+@njit(cache=True)
+def _treap_get_lower(element, subtree_sum, subtree_cnt, left_node, right_node, node, value):
+    '''
+    Gets number and sum of elements in the tree with root 'node' which have value less
+    than 'value', O(log n)
+    A plain walk down the tree accumulating the counters
+    '''
+    c = 0
+    s = 0.0
+    while node != -1:
+        if element[node] < value:
+            l = left_node[node]
+            if l != -1:
+                c += subtree_cnt[l]
+                s += subtree_sum[l]
+            c += 1
+            s += element[node]
+            node = right_node[node]
+        else:
+            node = left_node[node]
+    return c, s
 
 class Treap:
     '''
     Class representing a balanced binary search tree
     '''
     def __init__(self):
-        self.nodes = []     # storage of tree nodes
+        # parallel per-node storage: pre-sized for a chunk of nodes up front
+        # and grown by doubling, so insertions never allocate per node
+        self.capacity = 16
+        self.size = 0
+        self.element = np.empty(self.capacity, dtype=np.float32)     # values of stored elements
+        self.subtree_sum = np.empty(self.capacity, dtype=np.float32) # sums of values in subtrees (including the nodes)
+        self.subtree_cnt = np.empty(self.capacity, dtype=np.int32)   # numbers of nodes in subtrees (including the nodes)
+        self.weight = np.empty(self.capacity, dtype=np.int32)        # balancing weights
+        self.left_node = np.empty(self.capacity, dtype=np.int32)     # indices of left children (-1 if there are none)
+        self.right_node = np.empty(self.capacity, dtype=np.int32)    # indices of right children (-1 if there are none)
         self.root = -1      # index of root node (-1 means no root)
-    
+
+    # pool of pre-generated random balancing weights, shared by all trees
+    # and refilled in batches
+    _weight_pool = np.empty(0, dtype=np.int32)
+    _weight_pool_idx = 0
+
     def next_weight():
         '''
         Generates a new uniformly distributed random weight
+        (taken from a batch-generated pool of random int32 values)
         '''
-        return random.randint(-1e6, 1e6)
-    
-    def update_subtree(self, node):
-        '''
-        Updates subtree_sum and subtree_cnt of a node with index 'node' assuming that
-        all children have valid values, O(1)
-        '''
-        self.nodes[node].subtree_sum = self.nodes[node].element
-        self.nodes[node].subtree_cnt = 1
-        if self.nodes[node].left_node != -1:
-            self.nodes[node].subtree_sum += self.nodes[self.nodes[node].left_node].subtree_sum
-            self.nodes[node].subtree_cnt += self.nodes[self.nodes[node].left_node].subtree_cnt
-        if self.nodes[node].right_node != -1:
-            self.nodes[node].subtree_sum += self.nodes[self.nodes[node].right_node].subtree_sum    
-            self.nodes[node].subtree_cnt += self.nodes[self.nodes[node].right_node].subtree_cnt    
-    
-    def split(self, node, element):
-        '''
-        Splits the subtree with root at 'node' into two unconnected trees, the first containing
-        all elements lower than 'element'. Returns two roots, O(log n)
-        '''
-        if node == -1:
-            return -1, -1
-        else:
-            if element < self.nodes[node].element:
-                l, r = self.split(self.nodes[node].left_node, element)
-                self.nodes[node].left_node = r
-                self.update_subtree(node)
-                return l, node
-            else:
-                l, r = self.split(self.nodes[node].right_node, element)
-                self.nodes[node].right_node = l
-                self.update_subtree(node)
-                return node, r
-    
-    def join(self, left, right):
+        if Treap._weight_pool_idx == len(Treap._weight_pool):
+            Treap._weight_pool = np.random.randint(-10**6, 10**6, size=65536, dtype=np.int32)
+            Treap._weight_pool_idx = 0
+        ret = Treap._weight_pool[Treap._weight_pool_idx]
+        Treap._weight_pool_idx += 1
+        return ret
+
+    def _grow(self):
         '''
-        Joins two trees with root indices at 'left' and 'right' and returns a single root, O(log n)
+        Doubles the capacity of the per-node storage arrays
         '''
-        if left == -1 or right == -1:
-            return left if left != -1 else right
-        else:
-            if self.nodes[left].weight > self.nodes[right].weight:
-                self.nodes[left].right_node = self.join(self.nodes[left].right_node, right)
-                self.update_subtree(left)
-                return left
-            else:
-                self.nodes[right].left_node = self.join(left, self.nodes[right].left_node)
-                self.update_subtree(right)
-                return right
-    
+        self.capacity *= 2
+        self.element = np.resize(self.element, self.capacity)
+        self.subtree_sum = np.resize(self.subtree_sum, self.capacity)
+        self.subtree_cnt = np.resize(self.subtree_cnt, self.capacity)
+        self.weight = np.resize(self.weight, self.capacity)
+        self.left_node = np.resize(self.left_node, self.capacity)
+        self.right_node = np.resize(self.right_node, self.capacity)
+
     def add_element(self, element):
         '''
-        Adds a value 'element' in the tree (creating a new node), O(log n)
-        '''
-        new_node = TreapNode()
-        new_node.element = element
-        new_node.weight = Treap.next_weight()
-        self.nodes.append(new_node)
-        self.root = self.add_element_internal(self.root)
-    
-    def add_element_internal(self, node):
-        '''
-        Adds a node inside a subtree with root 'node', assuming that inserted element 
-        is positioned at the back of self.nodes list, O(log n)
+        Adds a value 'element' in the tree (filling in a new node), O(log n)
         '''
-        if node == -1:
-            self.update_subtree(-1)
-            return len(self.nodes) - 1
-        else:
-            if self.nodes[-1].weight > self.nodes[node].weight:
-                l, r = self.split(node, self.nodes[-1].element)
-                self.nodes[-1].left_node = l
-                self.nodes[-1].right_node = r
-                self.update_subtree(-1)
-                return len(self.nodes) - 1
-            else:
-                if self.nodes[-1].element < self.nodes[node].element:
-                    self.nodes[node].left_node = self.add_element_internal(self.nodes[node].left_node)
-                else:
-                    self.nodes[node].right_node = self.add_element_internal(self.nodes[node].right_node)
-                self.update_subtree(node)
-                return node
-    
+        if self.size == self.capacity:
+            self._grow()
+        new_node = self.size
+        self.size += 1
+        self.element[new_node] = element
+        self.weight[new_node] = Treap.next_weight()
+        self.left_node[new_node] = -1
+        self.right_node[new_node] = -1
+        self.root = _treap_add_element_internal(self.element, self.subtree_sum, self.subtree_cnt, \
+                                                self.left_node, self.right_node, self.weight, \
+                                                self.root, new_node)
+
     def get_lower(self, node, value):
         '''
         Gets number and sum of elements in the tree with root 'node' which have value less
         than 'value', O(log n)
         '''
-        if node == -1:
-            return 0, 0
-        if self.nodes[node].element < value:
-            c, s = self.get_lower(self.nodes[node].right_node, value)
-            if self.nodes[node].left_node != -1:
-                c += self.nodes[self.nodes[node].left_node].subtree_cnt
-                s += self.nodes[self.nodes[node].left_node].subtree_sum
-            return c + 1, s + self.nodes[node].element
-        else:
-            return self.get_lower(self.nodes[node].left_node, value)
\ No newline at end of file
+        c, s = _treap_get_lower(self.element, self.subtree_sum, self.subtree_cnt, \
+                                self.left_node, self.right_node, node, value)
+        return int(c), float(s)